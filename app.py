@@ -1,63 +1,200 @@
 import streamlit as st
-import pandas as pd
 import os
+import io
+import csv
 import json
-from openai import AzureOpenAI
+import hashlib
+import textwrap
+import functools
+import threading
+from collections import OrderedDict
+from itertools import zip_longest
+from typing import List, Union
+from typing_extensions import TypedDict
 from dotenv import load_dotenv
-import re
-from elasticsearch import Elasticsearch
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Define the model name
 MODEL = "gpt-4o-mini"
+TEMPERATURE = 0.7
 
-# Initialize Azure OpenAI client
-Azure_Client = AzureOpenAI(
-    api_key=os.getenv("AZURE_API"),
-    azure_endpoint=os.getenv("AZURE_BASE_URL"),
-    api_version=os.getenv("AZURE_API_VERSION")
-)
+# The answer is five short JSON records; the budget leaves headroom so it is not cut off
+MAX_TOKENS = 400
+
+# Static instructions for the model; only the query fields are filled in per request
+_SYSTEM_PROMPT_TEMPLATE = textwrap.dedent("""
+    You are an Immunologist and Vaccine Researcher. Using the clinical trial context, find the top 5 adjuvants for the vaccine type {vaccine_type} with properties and endpoints {adjuvant_properties}, clinical phase {clinical_phase}, pipeline {pipeline}, and study status {study_filter}.
+    Score each adjuvant from 0 to 10: favour safe, non-toxic, high-efficacy properties and endpoints, later clinical phases (Phase 3 and Phase 4), and completed or in-pipeline studies.
+    Answer with a JSON object of the form:
+    {{"Adjuvants": [{{"Adjuvant Name": "...", "Score": "...", "Insights": "..."}}]}}
+    Keep each Insights to one sentence on why the adjuvant suits {vaccine_type}. If you are not sure, say "not sure" in Insights.
+""").strip()
+
+class ResponseTruncated(Exception):
+    """
+    Raised when the model stops at the max_tokens limit instead of finishing its answer.
+    """
+
+# In-process LRU cache of model responses, keyed by a hash of the request.
+# Streamlit runs each session's script on its own thread, so access is locked.
+LLM_CACHE_SIZE = 256
+_LLM_CACHE = OrderedDict()
+_LLM_CACHE_LOCK = threading.Lock()
 
 # Elasticsearch connection details from environment variables
 ELASTICSEARCH_ENDPOINT = os.getenv('elasticsearchendpoint')
 ELASTIC_API_KEY = os.getenv('elasticapikey')
 
-# Initialize the Elasticsearch client
-es = Elasticsearch(ELASTICSEARCH_ENDPOINT, api_key=ELASTIC_API_KEY)
+@functools.cache
+def get_azure():
+    """
+    Create the Azure OpenAI client with a persistent keep-alive connection pool on first use.
+    DefaultHttpxClient keeps the SDK's own client defaults and only changes the pool and timeout.
+    """
+    import httpx
+    from openai import AzureOpenAI, DefaultHttpxClient
+
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_API"),
+        azure_endpoint=os.getenv("AZURE_BASE_URL"),
+        api_version=os.getenv("AZURE_API_VERSION"),
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+            timeout=30.0
+        )
+    )
+
+@functools.cache
+def get_es():
+    """
+    Create the Elasticsearch client on first use.
+    """
+    from elasticsearch import Elasticsearch
+
+    return Elasticsearch(
+        ELASTICSEARCH_ENDPOINT,
+        api_key=ELASTIC_API_KEY,
+        connections_per_node=25,
+        http_compress=True,
+        request_timeout=30,
+        retry_on_timeout=True,
+        max_retries=3
+    )
+
+# The number of hits is capped, since they all go into the prompt
+CLINICAL_TRIAL_INDEX = "matched_clinicaltrial"
+CLINICAL_TRIAL_SIZE = 50
+
+def _clinical_trial_query(vaccine_type):
+    """
+    Build the Elasticsearch query for clinical trials matching the vaccine type.
+    """
+    return {
+        "bool": {
+            "should": [
+                {"match": {"Conditions": vaccine_type}},
+                {"match": {"Conditions_x": vaccine_type}},
+                {"match": {"Intervention_Type": "BIOLOGICAL"}},
+                {"match": {"Modality": "Vaccine"}}
+            ]
+        }
+    }
 
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
 def fetch_clinical_trial_data(vaccine_type):
     """
     Fetch the clinical trial data from Elasticsearch based on the vaccine type.
     """
-    query = {
-        "query": {
-            "bool": {
-                "should": [
-                    {"match": {"Conditions": vaccine_type}},
-                    {"match": {"Conditions_x": vaccine_type}},
-                    {"match": {"Intervention_Type": "BIOLOGICAL"}},
-                    {"match": {"Modality": "Vaccine"}}
-                ]
-            }
-        },
-    }
+    query = _clinical_trial_query(vaccine_type)
     
-    response = es.search(index="matched_clinicaltrial", body=query)
+    # filter_path strips the hit metadata server-side, leaving only the documents
+    response = get_es().search(
+        index=CLINICAL_TRIAL_INDEX,
+        query=query,
+        size=CLINICAL_TRIAL_SIZE,
+        filter_path=["hits.hits._source"]
+    )
+    # filter_path drops the "hits" key entirely when nothing matches
     hits = response.get('hits', {}).get('hits', [])
     
+    return [hit['_source'] for hit in hits if hit.get('_source')]
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def fetch_many(vaccine_types):
+    """
+    Fetch the clinical trial data for several vaccine types in a single Multi Search request.
+    Hits are taken from each vaccine type in turn, trials matched more than once are returned once,
+    and the combined result is capped at CLINICAL_TRIAL_SIZE records.
+    """
+    searches = []
+    for vaccine_type in vaccine_types:
+        searches.append({"index": CLINICAL_TRIAL_INDEX})
+        searches.append({"query": _clinical_trial_query(vaccine_type), "size": CLINICAL_TRIAL_SIZE})
+
+    responses = get_es().msearch(searches=searches).get('responses', [])
+    if len(responses) != len(vaccine_types):
+        raise RuntimeError(
+            f"Expected {len(vaccine_types)} search results but received {len(responses)}."
+        )
+
+    hits_per_type = []
+    for vaccine_type, item in zip(vaccine_types, responses):
+        # A failed sub-search carries an "error" instead of hits
+        if 'error' in item:
+            reason = item['error'].get('reason', item['error'])
+            raise RuntimeError(f"Search for vaccine type '{vaccine_type}' failed: {reason}")
+        hits_per_type.append(item.get('hits', {}).get('hits', []))
+
     clinical_trial_data = []
-    for hit in hits:
-        clinical_trial_data.append(hit['_source'])
-    
+    seen_ids = set()
+    for ranked_hits in zip_longest(*hits_per_type):
+        for hit in ranked_hits:
+            if hit is None or hit['_id'] in seen_ids or not hit.get('_source'):
+                continue
+            seen_ids.add(hit['_id'])
+            clinical_trial_data.append(hit['_source'])
+            if len(clinical_trial_data) == CLINICAL_TRIAL_SIZE:
+                return clinical_trial_data
+
     return clinical_trial_data
 
-def user_input(Input_df, user_query):
+# Expected shape of the model's JSON answer
+Adjuvant = TypedDict("Adjuvant", {
+    "Adjuvant Name": str,
+    "Score": Union[int, float, str],
+    "Insights": str
+})
+AdjuvantResponse = TypedDict("AdjuvantResponse", {"Adjuvants": List[Adjuvant]})
+
+@functools.cache
+def _adjuvant_response_adapter():
+    """
+    Build the pydantic validator for the model's answer on first use.
+    """
+    from pydantic import TypeAdapter
+
+    return TypeAdapter(AdjuvantResponse)
+
+def parse_adjuvants(answer):
     """
-    Prepare the prompt for the model. This function converts the DataFrame into a string to use as context.
+    Validate the model's JSON answer and return its list of adjuvant records.
     """
-    context = Input_df.to_string(index=False)
+    return _adjuvant_response_adapter().validate_json(answer)["Adjuvants"]
+
+def user_input(records, user_query):
+    """
+    Prepare the prompt for the model. This function writes the clinical trial records as a compact
+    pipe-delimited table, without column padding, to use as context.
+    """
+    # Every field present in any record becomes a column, in first-seen order
+    columns = list(dict.fromkeys(field for record in records for field in record))
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=columns, delimiter="|", lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(records)
+    context = buf.getvalue()
     prompt = f"""
     This is Clinical Trial data for the Vaccine Adjuvant entered by the user: {user_query}.
     This is the context of the clinical trial data: {context}
@@ -65,60 +202,88 @@ def user_input(Input_df, user_query):
     
     return prompt
 
-def get_response(prompt, user_query):
+def _cache_key(model, system_prompt, prompt, temperature):
     """
-    Constructs a system message based on the user query, then sends both system and user messages
-    to the Azure OpenAI model and returns its response.
+    Build a deterministic cache key for a model request.
     """
-    query_parts = user_query.split(" | ")
-    if len(query_parts) < 5:
-        raise ValueError("User query does not contain all required fields.")
-    
-    vaccine_type = query_parts[0].split(":")[1].strip()
-    adjuvant_properties = query_parts[1].split(":")[1].strip()
-    study_filter = query_parts[2].split(":")[1].strip()
-    pipeline = query_parts[3].split(":")[1].strip()
-    clinical_phase = query_parts[4].split(":")[1].strip()
-
-    system_prompt = f"""
-    You are an Immunologist and Vaccine Researcher. Your task is to find the adjuvants for the vaccine type along with its properties, endpoints, clinical phase, pipeline, and study status.
-    You are given the context of the clinical trial data and the user query.
-    INSTRUCTIONS:
-    1. Read the user query and the context carefully.
-    2. Find the adjuvants for the vaccine type {vaccine_type} along with its properties and endpoints {adjuvant_properties}, clinical phase {clinical_phase}, and study status {study_filter}.
-    3. Calculate the score for the adjuvants based on the properties and endpoints (should be safe, non-toxic, and have high efficacy), clinical phase (with higher weight for phases like Phase 3 and Phase 4), and the pipeline/study status (completed or in-pipeline get higher scores).
-    4. Provide the answer in JSON format with the following keys and make sure to keep the format consistent for all outputs:
-       {{
-           "Adjuvant Name": "Adjuvant Name_1",
-           "Score": "Score_1",
-           "Insights": "Insights_1"
-       }},
-       {{
-           "Adjuvant Name": "Adjuvant Name_2",
-           "Score": "Score_2",
-           "Insights": "Insights_2"
-       }}
-    5. The score should be between 0 and 10, and only provide the top 5 adjuvants.
-    6. If you are not sure, please say "not sure".
-    7. remove the ```tags.
-    
-    Output format:
-    1. Adjuvant Name: "Adjuvant Name"
-    2. Score: "Score"
-    3. Provides insights about the score and why the adjuvant will be effective for the vaccine type {vaccine_type}.
+    payload = json.dumps(
+        {"m": model, "s": system_prompt, "u": prompt, "t": temperature},
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_response_stream(prompt, *, vaccine_type, adjuvant_properties, study_filter, pipeline,
+                        clinical_phase, use_cache=False):
     """
+    Constructs a system message from the query fields, then sends both system and user messages
+    to the Azure OpenAI model and yields its response as it is generated.
+    When use_cache is set, identical requests are answered from the in-process LRU cache.
+    """
+    system_prompt = _SYSTEM_PROMPT_TEMPLATE.format(
+        vaccine_type=vaccine_type,
+        adjuvant_properties=adjuvant_properties,
+        study_filter=study_filter,
+        pipeline=pipeline,
+        clinical_phase=clinical_phase
+    )
     
-    response = Azure_Client.chat.completions.create(
+    prompt = prompt.strip()
+
+    key = _cache_key(MODEL, system_prompt, prompt, TEMPERATURE)
+    cached = None
+    if use_cache:
+        with _LLM_CACHE_LOCK:
+            if key in _LLM_CACHE:
+                _LLM_CACHE.move_to_end(key)
+                cached = _LLM_CACHE[key]
+    if cached is not None:
+        yield cached
+        return
+
+    stream = get_azure().chat.completions.create(
         model=MODEL,
         messages=[
-            {"role": "system", "content": system_prompt.strip()},
-            {"role": "user", "content": prompt.strip()}
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
         ],
-        temperature=0.7,
-        max_tokens=500
+        temperature=TEMPERATURE,
+        max_tokens=MAX_TOKENS,
+        response_format={"type": "json_object"},
+        stream=True
     )
-    
-    return response.choices[0].message.content.strip()
+
+    buf = []
+    finish_reason = None
+    for chunk in stream:
+        # Azure may send chunks without choices (e.g. content filter results)
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+        token = choice.delta.content or ""
+        buf.append(token)
+        yield token
+
+    # JSON mode only guarantees valid JSON when the model stops on its own
+    if finish_reason == "length":
+        raise ResponseTruncated(f"Model response was truncated at the {MAX_TOKENS}-token limit.")
+
+    if not use_cache or finish_reason != "stop":
+        return
+
+    # Only cache complete answers that validate, so a broken answer is never replayed
+    answer = "".join(buf).strip()
+    try:
+        parse_adjuvants(answer)
+    except ValueError:
+        return
+
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE[key] = answer
+        _LLM_CACHE.move_to_end(key)
+        if len(_LLM_CACHE) > LLM_CACHE_SIZE:
+            _LLM_CACHE.popitem(last=False)
 
 def main():
     st.title("VaccX")
@@ -135,9 +300,17 @@ def main():
         pipeline_status = st.text_input("Enter the Pipeline Status")
         clinical_phase = st.text_input("Enter the Clinical Phase")
 
+    # Temperature is non-zero, so reusing a previous answer is opt-in
+    use_cache = st.checkbox("Reuse cached responses for identical queries")
+
+    # Drop cached Elasticsearch results, e.g. after the index has been updated
+    if st.button("Refresh"):
+        fetch_clinical_trial_data.clear()
+        fetch_many.clear()
+
     # Process input only when Submit is clicked
     if st.button("Submit"):
-        # Build the user query string using the pipe symbol as the field delimiter
+        # Build the user query string for display in the prompt
         user_query = (
             f"Vaccine Type: {vaccine_type} | "
             f"Adjuvant Properties: {adjuvant_prop} | "
@@ -146,84 +319,89 @@ def main():
             f"Clinical Phase: {clinical_phase}"
         )
         
-        # Fetch clinical trial data from Elasticsearch
+        vaccine_types = [v.strip() for v in vaccine_type.split(",") if v.strip()]
+        if not vaccine_types:
+            st.error("Please enter a vaccine type.")
+            return
+        
+        # Fetch clinical trial data from Elasticsearch, batching comma-separated vaccine types
         with st.spinner("Fetching clinical trial data..."):
-            clinical_trial_data = fetch_clinical_trial_data(vaccine_type)
+            try:
+                if len(vaccine_types) > 1:
+                    clinical_trial_data = fetch_many(vaccine_types)
+                else:
+                    clinical_trial_data = fetch_clinical_trial_data(vaccine_types[0])
+            except RuntimeError as e:
+                st.error("Error fetching clinical trial data: " + str(e))
+                return
         
         if not clinical_trial_data:
             st.error("No clinical trial data found for the given vaccine type.")
             return
         
-        clinical_trial_df = pd.DataFrame(clinical_trial_data)
-        
         # Build the prompt for the model
-        prompt = user_input(clinical_trial_df, user_query)
-        
-            # Get the response from the Azure OpenAI model
-        with st.spinner("Querying the model..."):
-            answer = get_response(prompt, user_query)
-            print("Model response: ", answer)
+        prompt = user_input(clinical_trial_data, user_query)
         
         st.subheader("ADJUVANTS FOR VACCINE")
+
+        # Stream the response from the Azure OpenAI model, rendering tokens as they arrive
+        placeholder = st.empty()
+        buf = []
+        stream = get_response_stream(
+            prompt,
+            vaccine_type=vaccine_type,
+            adjuvant_properties=adjuvant_prop,
+            study_filter=study_status,
+            pipeline=pipeline_status,
+            clinical_phase=clinical_phase,
+            use_cache=use_cache
+        )
         try:
-            # Clean the answer: remove markdown code block formatting if present
-            answer_clean = answer.strip()
-            if answer_clean.startswith("```"):
-                parts = answer_clean.split("```")
-                if len(parts) >= 3:
-                    answer_clean = parts[1].strip()
-                    # Remove any leading "json" language identifier if present
-                    if answer_clean.lower().startswith("json"):
-                        answer_clean = answer_clean.split("\n", 1)[1].strip()
-            
-            # First, try to parse the entire cleaned answer as JSON
-            try:
-                parsed = json.loads(answer_clean)
-            except json.JSONDecodeError:
-                # Fallback: Use regex to extract individual JSON objects (less ideal)
-
-                json_objects = re.findall(r'\{.*?\}', answer_clean, re.DOTALL)
-                if not json_objects:
-                    raise ValueError("No JSON objects found in the model response.")
-                parsed = [json.loads(obj) for obj in json_objects]
-            
-            # Normalize the parsed data:
-            if isinstance(parsed, dict):
-                # If the dictionary has a key that holds a list (e.g., "Adjuvants"), extract it;
-                # otherwise, wrap the dict in a list.
-                if "Adjuvants" in parsed and isinstance(parsed["Adjuvants"], list):
-                    data = parsed["Adjuvants"]
-                else:
-                    data = [parsed]
-            elif isinstance(parsed, list):
-                data = parsed
-            else:
-                raise ValueError("Parsed JSON has an unexpected format.")
+            for token in stream:
+                buf.append(token)
+                placeholder.markdown("".join(buf))
+        except ResponseTruncated as e:
+            placeholder.empty()
+            st.error(str(e))
+            st.text("Raw answer: " + "".join(buf))
+            return
+        answer = "".join(buf).strip()
+        print("Model response: ", answer)
+        placeholder.empty()
+
+        try:
+            # JSON mode guarantees a JSON object, so it is validated and unpacked directly
+            data = parse_adjuvants(answer)
             
+            # pandas is only needed to render the results, so it is imported on first use
+            import pandas as pd
+
             # Create a DataFrame from the dynamic data
             df_output = pd.DataFrame(data)
             
-            # Create a styled version of the DataFrame with text wrapping in the Insights column.
-            styled_df = df_output.style.set_properties(
-                subset=["Insights"],
-                **{"white-space": "normal", "word-wrap": "break-word"}
-            )
+            # Wrap text in the Insights column, located by its position in the table.
+            wrap_css = ""
+            if "Insights" in df_output.columns:
+                insights_col = df_output.columns.get_loc("Insights") + 1
+                wrap_css = (
+                    f".adj-tbl td:nth-child({insights_col}) "
+                    "{ white-space: normal; word-wrap: break-word; }"
+                )
             
             # Define custom CSS for additional styling.
-            custom_css = """
+            custom_css = f"""
             <style>
-            table { width: 100%; border-collapse: collapse; }
-            th { font-weight: bold; text-align: left; padding: 8px; border-bottom: 2px solid #ddd; }
-            td { padding: 8px; border-bottom: 1px solid #ddd; }
+            table {{ width: 100%; border-collapse: collapse; }}
+            th {{ font-weight: bold; text-align: left; padding: 8px; border-bottom: 2px solid #ddd; }}
+            td {{ padding: 8px; border-bottom: 1px solid #ddd; }}
+            {wrap_css}
             </style>
             """
             
-            # Generate the HTML from the styled DataFrame
-            html_styled = styled_df.to_html()
-            # Remove inline CSS produced by the Styler (the first <style>...</style> block)
-            html_clean = re.sub(r'<style[^>]*>.*?</style>', '', html_styled, flags=re.DOTALL)
+            # Generate the HTML table directly, without the Styler
+            html_clean = df_output.to_html(index=False, escape=True, classes="adj-tbl")
             
-            # Render the final HTML with your custom CSS only
+            # Render the final HTML with the custom CSS
             st.markdown(custom_css + html_clean, unsafe_allow_html=True)
 
             